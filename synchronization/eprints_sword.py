@@ -7,6 +7,23 @@ import mimetypes
 import zipfile
 import re
 import time
+import heapq
+import json
+import atexit
+import cProfile
+import functools
+import pstats
+import tracemalloc
+import hashlib
+import errno
+import shlex
+import struct
+from collections import deque
+import mmap
+import threading
+import zlib
+import sqlite3
+from urllib.parse import urlsplit
 from datetime import datetime, date, timezone, timedelta
 from zipfile import ZIP_DEFLATED
 import netrc
@@ -15,6 +32,7 @@ from pathlib import Path
 import urllib3
 import xml.etree.ElementTree as ET
 import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # Disable warnings about insecure HTTPS requests (self-signed certificates)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -44,10 +62,68 @@ dotenv_path = Path(f'{current_file_path.parent}/.env')
 load_dotenv(dotenv_path=dotenv_path)
 
 # Constants
-BASE_URL = 'https://epub-test.uni-regensburg.de'
+SERVERS = {
+    'test': 'https://epub-test.uni-regensburg.de',
+    'live': 'https://epub.uni-regensburg.de',
+}
 USE_LIVE_SERVER = os.getenv("USE_LIVE_SERVER", "False").lower() in ("true", "1", "t")
-VERIFY = USE_LIVE_SERVER
-BASE_URL = 'https://epub.uni-regensburg.de' if USE_LIVE_SERVER else BASE_URL
+DEFAULT_SERVER = 'live' if USE_LIVE_SERVER else 'test'
+BASE_URL = SERVERS[DEFAULT_SERVER]
+# Comma separated list of servers to sync to in one run, e.g. "test,live"
+SYNC_TARGETS = os.getenv("SYNC_TARGETS", "")
+
+# Text payloads that are sent with Content-Encoding: gzip when compression is enabled.
+# Archives and PDFs are already compressed and are always sent as they are.
+COMPRESSIBLE_EXTENSIONS = ['.html', '.xml', '.yml']
+DEFAULT_COMPRESS_LEVEL = 6
+COMPRESS_CHUNK_SIZE = 64 * 1024
+
+# Hosts that answered a gzip encoded upload with 415 Unsupported Media Type
+gzip_rejected_hosts = set()
+
+# Upload tiers from most to least important, see get_upload_tier
+UPLOAD_TIERS = ['html', 'yml', 'recent', 'xml', 'other']
+UPLOAD_ORDER = ','.join(UPLOAD_TIERS)
+# Recordings changed within this many hours count as "recent"
+RECENT_HOURS = 24
+
+# Repository id of the EPrints servers, part of the export URLs
+REPOSITORY_ID = 'epub'
+# Number of eprints whose state is fetched with one search export request
+SUMMARY_BATCH_SIZE = 100
+
+# Files of at least this size are memory-mapped for hashing instead of read in chunks
+MMAP_THRESHOLD = 16 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Without a terminal, the upload progress is logged at most every this many seconds
+PROGRESS_INTERVAL = 10
+# Uploads taking longer than this many seconds are logged as slow
+SLOW_UPLOAD_SECONDS = 60
+
+# Archives built by create_zips and the extensions of their members, yml files go into every archive
+ZIP_ARCHIVES = {'xml.zip': ['.xml'], 'pdf.zip': ['.pdf']}
+# Members compressed at the same time when building an archive
+ZIP_WORKERS = os.cpu_count() or 1
+
+# Local queue of experiments to upload, filled with --spool and uploaded with --drain
+SPOOL_DB = os.getenv("SPOOL_DB", str(current_file_path.parent / 'spool.sqlite'))
+SPOOL_WORKERS = 4
+# Failed jobs are retried after 1, 2, 4, ... minutes, at most SPOOL_RETRY_MAX seconds apart,
+# and become dead letters after SPOOL_MAX_ATTEMPTS attempts
+SPOOL_MAX_ATTEMPTS = 8
+SPOOL_RETRY_BASE = 60
+SPOOL_RETRY_MAX = 6 * 3600
+# Workers refresh the updated time of their running job this often, see spool_heartbeat.
+# Running jobs not updated for SPOOL_STALE_SECONDS belong to a worker that crashed and are picked up again
+SPOOL_HEARTBEAT_SECONDS = 60
+SPOOL_STALE_SECONDS = 15 * 60
+
+# Number of entries in each --profile report
+PROFILE_TOP = 50
+
+# Serializes writes of eprint ids into the YAML file when several targets are synced at once
+yaml_lock = threading.Lock()
 
 # Notify if using the live server
 if USE_LIVE_SERVER:
@@ -59,6 +135,127 @@ try:
 except NameError:
     pass
 
+# Set by --profile
+profiling = False
+# Function name -> (calls, total seconds, longest call) of the functions tagged with @profiled
+profile_timings = {}
+# The cProfile profilers of the run, see run_profiled
+profilers = []
+profile_lock = threading.Lock()
+
+
+def profiled(func):
+    """Tag a function so its number of calls and wall time are reported with --profile."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not profiling:
+            return func(*args, **kwargs)
+
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with profile_lock:
+                calls, total, longest = profile_timings.get(func.__name__, (0, 0.0, 0.0))
+                profile_timings[func.__name__] = (calls + 1, total + elapsed, max(longest, elapsed))
+
+    return wrapper
+
+
+def run_profiled(func, *args):
+    """
+    Run func in a profiler of its own when profiling, for functions that run in worker threads.
+
+    Before Python 3.12 cProfile only sees the thread it was enabled in. Since 3.12 it is based on
+    sys.monitoring, only one profiler can be active per process and the main profiler sees all threads.
+    """
+    if not profiling or sys.version_info >= (3, 12):
+        return func(*args)
+
+    profiler = cProfile.Profile()
+    with profile_lock:
+        profilers.append(profiler)
+    return profiler.runcall(func, *args)
+
+
+def write_profile_reports(directory):
+    """Write the CPU, allocation and tagged function reports of a --profile run to directory."""
+    for profiler in profilers:
+        profiler.disable()
+
+    os.makedirs(directory, exist_ok=True)
+
+    # Raw data for tools like snakeviz or gprof2dot
+    pstats.Stats(*profilers).dump_stats(os.path.join(directory, 'cpu.prof'))
+    for sort_key in ['cumulative', 'tottime']:
+        with open(os.path.join(directory, f'cpu_{sort_key}.txt'), 'w') as report:
+            pstats.Stats(*profilers, stream=report).sort_stats(sort_key).print_stats(PROFILE_TOP)
+
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        # Leave out the allocations of the profilers themselves
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+        tracemalloc.stop()
+        with open(os.path.join(directory, 'memory.txt'), 'w') as report:
+            report.write(f"Current: {format_bytes(current)}, peak: {format_bytes(peak)}\n\n")
+            for statistic in snapshot.statistics('lineno')[:PROFILE_TOP]:
+                report.write(f"{statistic}\n")
+
+    with open(os.path.join(directory, 'functions.txt'), 'w') as report:
+        report.write(f"{'function':<30} {'calls':>8} {'total s':>10} {'mean s':>10} {'max s':>10}\n")
+        for name, (calls, total, longest) in sorted(profile_timings.items(), key=lambda item: -item[1][1]):
+            report.write(f"{name:<30} {calls:>8} {total:>10.3f} {total / calls:>10.3f} {longest:>10.3f}\n")
+
+    logging.info(f"Profile reports written to {directory}")
+
+
+def make_target(name, user=False, password=None):
+    """
+    Create the description of a server to synchronize with.
+
+    The SSL certificate is only verified on the live server, the test server uses a self-signed one.
+    """
+    return {
+        'name': name,
+        'base_url': SERVERS[name],
+        'verify': name == 'live',
+        'user': user,
+        'password': password,
+    }
+
+
+def get_auth(target):
+    """Return the basic auth tuple for requests, or None so requests falls back to netrc."""
+    if target['user']:
+        return target['user'], target['password']
+    return None
+
+
+def get_epid_key(target):
+    """YAML key holding the eprint id on the given server, "epid.<name>"."""
+    return 'epid.' + target['name']
+
+
+def get_epid(doc, target):
+    """
+    Eprint id of the experiment on the given server from the YAML document, or None.
+
+    YAML files written before the server specific keys only have a plain "epid". It is read as a fallback
+    for the server configured in .env, and only if that server has no key of its own, so an id of the test
+    server is never used on the live server once both keys exist.
+    """
+    if get_epid_key(target) in doc:
+        return doc[get_epid_key(target)]
+    if target['name'] == DEFAULT_SERVER:
+        return doc.get('epid')
+    return None
+
 
 def get_content_type(file_path):
     """Guess the MIME type of a file based on its extension."""
@@ -83,37 +280,304 @@ def pretty_print_POST(req):"""
     ))
 
 
-def curl_send_file(file, url, action='POST'):
-    """Send a file using the curl command with shell=True and capture output."""
-    _, filename = os.path.split(file)
+def get_upload_tier(file, mtime, recent_since):
+    """
+    Return the name of the upload tier of a file.
+
+    html: evaluation reports, yml: the experiment description, recent: recordings changed since recent_since,
+    xml: all other recordings, other: everything else
+    """
+    _, file_extension = os.path.splitext(file)
+    file_extension = file_extension.lower()
+
+    if file_extension == '.html':
+        return 'html'
+    if file_extension == '.yml':
+        return 'yml'
+    if file_extension == '.xml':
+        return 'recent' if mtime >= recent_since else 'xml'
+    return 'other'
+
+
+@profiled
+def build_upload_queue(files, order=UPLOAD_ORDER, recent_hours=RECENT_HOURS, stats=None):
+    """
+    Build a priority queue (heap) of files to upload.
+
+    Files are ordered by the position of their tier in order (tiers not listed come last),
+    then by size so small files become visible first, then by newest modification.
+    Pop the entries with heapq.heappop; the file path is the last element.
+    stats can hold os.stat results of the files that are already known.
+    """
+    tiers = [tier.strip() for tier in order.split(',') if tier.strip()]
+    recent_since = time.time() - recent_hours * 3600
+
+    queue = []
+    for file in files:
+        stat = stats[file] if stats and file in stats else os.stat(file)
+        tier = get_upload_tier(file, stat.st_mtime, recent_since)
+        priority = tiers.index(tier) if tier in tiers else len(tiers)
+        heapq.heappush(queue, (priority, stat.st_size, -stat.st_mtime, file))
+
+    return queue
+
+
+def is_compressible(file):
+    """Check if a file should be gzip encoded for upload based on its extension."""
+    _, file_extension = os.path.splitext(file)
+    return file_extension.lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def get_http_status(curl_output):
+    """Return the status code of the final HTTP response in the output of curl -i, or None."""
+    status_codes = re.findall(r'^HTTP/[\d.]+ (\d{3})', curl_output, re.MULTILINE)
+    if status_codes:
+        return int(status_codes[-1])
+    return None
+
+
+def write_gzip_stream(file, pipe, level):
+    """Compress a file chunk by chunk into a pipe, so curl can upload while compressing."""
+    # wbits=31 writes a gzip header and trailer instead of a raw zlib stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(COMPRESS_CHUNK_SIZE), b''):
+            pipe.write(compressor.compress(chunk))
+        pipe.write(compressor.flush())
+
+
+def run_curl(cmd, file=None, compress_level=None, write_body=None):
+    """
+    Run a curl command and capture its output.
+
+    The request body is fed through stdin by write_body(pipe) in a thread, or is the gzip compressed file
+    if compress_level is set. curl only reads the whole body from stdin before sending it (--data-binary @-),
+    so this saves a temporary file, not memory.
+
+    If write_body fails (e.g. a file cannot be read), curl is killed before it sees the end of the body,
+    so nothing truncated is sent, and a failed result with the error in stderr is returned.
+    """
+    logging.debug(f"Running command: {cmd}")
+
+    if write_body is None and compress_level is not None:
+        write_body = functools.partial(write_gzip_stream, file, level=compress_level)
+
+    if write_body is None:
+        # Using shell=True, pass the command as a string.
+        return subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    # A plain os.pipe is used instead of stdin=PIPE so communicate() can drain stdout/stderr
+    # while the compression thread is still writing
+    read_fd, write_fd = os.pipe()
+    # Without a shell, so killing the process kills curl itself
+    args = cmd if os.name == 'nt' else shlex.split(cmd)
+    process = subprocess.Popen(args, stdin=read_fd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    os.close(read_fd)
+
+    body_errors = []
 
-    if user:
+    def feed_body(pipe):
+        try:
+            write_body(pipe)
+        except BrokenPipeError as err:
+            # curl exited early (e.g. the server rejected the request), its output tells why
+            logging.debug(f"Request body stream stopped: {err}")
+        except Exception as err:
+            if isinstance(err, OSError) and err.errno == errno.EPIPE:
+                logging.debug(f"Request body stream stopped: {err}")
+            else:
+                # Killed before the pipe is closed, curl would send the truncated body on end of file
+                body_errors.append(err)
+                process.kill()
+        finally:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    writer = threading.Thread(target=feed_body, args=(os.fdopen(write_fd, 'wb'),), daemon=True)
+    writer.start()
+    stdout, stderr = process.communicate()
+    writer.join()
+
+    if body_errors:
+        err = body_errors[0]
+        logging.warning(f"Request body could not be written, nothing was sent: {err}")
+        return subprocess.CompletedProcess(cmd, process.returncode or 1, stdout,
+                                           stderr + f"\nRequest body could not be written: "
+                                                    f"{type(err).__name__}: {err}")
+
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+
+def get_remote_id(curl_output):
+    """Return the id at the end of the Location header in the output of curl -i, or None."""
+    locations = re.findall(r'^Location:\s*(\S+)', curl_output, re.MULTILINE | re.IGNORECASE)
+    if locations:
+        return locations[-1].rstrip('/').split('/')[-1]
+    return None
+
+
+def format_bytes(size):
+    """Format a number of bytes for humans, e.g. 1.5 MB."""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_duration(seconds):
+    """Format seconds as h:mm:ss, or ? if unknown."""
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class UploadEvents:
+    """
+    Stream of per-file upload events (queued, started, finished, failed).
+
+    Every event is written as one JSON line to stream, if given, e.g.
+    {"time": "2025-03-19T09:34:42.123+00:00", "event": "finished", "target": "test", "file": "wtb_color_01.xml",
+     "bytes": 52340, "duration": 0.81, "status": 201, "remote_id": "30264"}
+
+    The byte counts of the events drive a live throughput and ETA display: a progress bar on a terminal,
+    a log line every PROGRESS_INTERVAL seconds otherwise (e.g. when logging to a file from the Task Scheduler).
+    Events can be emitted from several threads.
+    """
+
+    def __init__(self, stream=None, live=None):
+        self.stream = stream
+        self.live = sys.stdout.isatty() if live is None else live
+        self.lock = threading.Lock()
+        self.total_files = 0
+        self.total_bytes = 0
+        self.done_files = 0
+        self.done_bytes = 0
+        self.failed_files = 0
+        self.start_time = None
+        self.last_report = 0
+
+    def emit(self, event, **fields):
+        """Record an event with its fields, bytes is used for the throughput."""
+        record = {'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'), 'event': event}
+        record.update(fields)
+
+        with self.lock:
+            if event == 'queued':
+                self.total_files += 1
+                self.total_bytes += fields.get('bytes', 0)
+            elif event == 'started' and self.start_time is None:
+                self.start_time = time.monotonic()
+            elif event in ('finished', 'failed'):
+                self.done_files += 1
+                self.done_bytes += fields.get('bytes', 0)
+                if event == 'failed':
+                    self.failed_files += 1
+
+            if self.stream is not None:
+                self.stream.write(json.dumps(record) + "\n")
+                self.stream.flush()
+
+            if event in ('finished', 'failed'):
+                self.report_progress()
+
+    def report_progress(self, final=False):
+        """Show the progress by bytes with throughput and remaining time."""
+        now = time.monotonic()
+        elapsed = now - self.start_time if self.start_time is not None else 0
+        rate = self.done_bytes / elapsed if elapsed > 0 else 0
+        eta = (self.total_bytes - self.done_bytes) / rate if rate > 0 else None
+
+        text = (f"{self.done_files}/{self.total_files} files, "
+                f"{format_bytes(self.done_bytes)}/{format_bytes(self.total_bytes)}, "
+                f"{format_bytes(rate)}/s, ETA {format_duration(eta)}")
+        if self.failed_files:
+            text += f", {self.failed_files} failed"
+
+        if self.live:
+            bar_length = 40
+            progress = self.done_bytes / self.total_bytes if self.total_bytes else 1
+            block = int(round(bar_length * min(progress, 1)))
+            sys.stdout.write(f"\rUploading: [{'#' * block + '-' * (bar_length - block)}] {progress * 100:.1f}% {text}")
+            sys.stdout.flush()
+            if final:
+                print()
+        elif final or now - self.last_report >= PROGRESS_INTERVAL:
+            logging.info(f"Uploaded {text}")
+            self.last_report = now
+
+    def close(self):
+        """Show the final progress."""
+        with self.lock:
+            if self.total_files:
+                self.report_progress(final=True)
+
+
+def get_curl_command(target, data, filename, url, action='POST', content_type='text/html', extra_headers=''):
+    """Return the curl command uploading data (@file, or @- for stdin) as filename, with the target's credentials."""
+    if target['user']:
         cmd = (
-            'curl -X {action} -ik -u "{user}:{password}" --data-binary "@{file}" '
-            '-H "Content-Type: text/html" -H "Content-Disposition: attachment; filename={filename}" {url}'
-        ).format(action=action, user=user, password=password, file=file, filename=filename, url=url)
+            'curl -X {action} -iksS -u "{user}:{password}" --data-binary "{data}" '
+            '-H "Content-Type: {content_type}" -H "Content-Disposition: attachment; filename={filename}"'
+            '{extra_headers} {url}'
+        ).format(action=action, user=target['user'], password=target['password'], data=data,
+                 content_type=content_type, filename=filename, extra_headers=extra_headers, url=url)
     else:
         cmd = (
-            'curl -X {action} -ik --netrc --data-binary "@{file}" '
-            '-H "Content-Type: text/html" -H "Content-Disposition: attachment; filename={filename}" {url}'
-        ).format(action=action, file=file, filename=filename, url=url)
+            'curl -X {action} -iksS --netrc --data-binary "{data}" '
+            '-H "Content-Type: {content_type}" -H "Content-Disposition: attachment; filename={filename}"'
+            '{extra_headers} {url}'
+        ).format(action=action, data=data, content_type=content_type, filename=filename,
+                 extra_headers=extra_headers, url=url)
+    return cmd
 
-    logging.debug(f"Running command: {cmd}")
 
-    # Using shell=True, pass the command as a string.
-    result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+@profiled
+def curl_send_file(target, file, url, action='POST', compress_level=None, write_body=None):
+    """
+    Send a file using the curl command with shell=True and capture output.
+
+    If compress_level is set, text files are gzip compressed on the fly and sent with
+    Content-Encoding: gzip. When the server answers with 415, the file is sent again
+    uncompressed and further uploads to that host skip compression.
+    If write_body is set, it writes the request body (see run_curl) and file is only its name.
+    """
+    _, filename = os.path.split(file)
+    host = urlsplit(url).netloc
+
+    compress = (write_body is None and compress_level is not None and is_compressible(file)
+                and host not in gzip_rejected_hosts)
+    # curl reads the request body from stdin when compressing or when it is written by write_body
+    data = "@-" if compress or write_body is not None else "@" + file
+    extra_headers = ' -H "Content-Encoding: gzip"' if compress else ''
+    # Text files are sent as text/html as they always were, archives with their own type
+    content_type = 'text/html' if is_compressible(file) else get_content_type(file)
+
+    cmd = get_curl_command(target, data, filename, url, action=action, content_type=content_type,
+                           extra_headers=extra_headers)
+    result = run_curl(cmd, file, compress_level if compress else None, write_body)
 
     logging.debug("Return code:%s", result.returncode)
     logging.debug("Standard Output:\n%s", result.stdout)
     logging.debug("Standard Error:\n%s", result.stderr)
 
+    if compress and get_http_status(result.stdout) == 415:
+        logging.info(f"{host} does not accept gzip encoded uploads, sending uncompressed")
+        gzip_rejected_hosts.add(host)
+        return curl_send_file(target, file, url, action=action, compress_level=None)
+
     return result
 
 
-def send_sword_request(data, content_type, send_file=False, headers=None, url=BASE_URL + '/id/contents', action='POST'):
+def send_sword_request(target, data, content_type, send_file=False, headers=None, url=None, action='POST'):
     """Send a single SWORD request for file upload."""
     if headers is None:
         headers = {}
+    if url is None:
+        url = target['base_url'] + '/id/contents'
     s = requests.Session()
 
     h = {'Content-Type': content_type, 'Accept-Charset': 'UTF-8'}
@@ -128,15 +592,9 @@ def send_sword_request(data, content_type, send_file=False, headers=None, url=BA
         files = {'file': (filename, zip, content_type)}
         fc = {'Content-Disposition': 'attachment; filename=' + filename}
         headers.update(fc)
-        if user:
-            r = requests.Request(action, url, files=files, headers=headers, auth=(user, password))
-        else:
-            r = requests.Request(action, url, files=files, headers=headers)
+        r = requests.Request(action, url, files=files, headers=headers, auth=get_auth(target))
     else:
-        if user:
-            r = requests.Request(action, url, data=data, headers=headers, auth=(user, password))
-        else:
-            r = requests.Request(action, url, data=data, headers=headers)
+        r = requests.Request(action, url, data=data, headers=headers, auth=get_auth(target))
 
     prepared = r.prepare()
 
@@ -144,7 +602,7 @@ def send_sword_request(data, content_type, send_file=False, headers=None, url=BA
     #    pretty_print_POST(prepared)
 
     # Verify ssl certificate
-    resp = s.send(prepared, verify=VERIFY)
+    resp = s.send(prepared, verify=target['verify'])
     if verbose:
         logging.debug(resp.status_code)
         logging.debug(resp.raise_for_status())
@@ -164,11 +622,36 @@ def send_sword_request(data, content_type, send_file=False, headers=None, url=BA
         return -1
 
 
-def get_document_ids(epid, experiment_name, yaml_timestamp=None, type='fileid'):
+def parse_lastmod(eprint_elem):
+    """Return the <lastmod> of an eprint (or of the first eprint of an export) as UTC datetime, or None."""
+    ns_eprint = {'ep2': 'http://eprints.org/ep2/data/2.0'}
+
+    # Exports wrap the eprint in <eprints>
+    wrapped_eprint = eprint_elem.find('ep2:eprint', ns_eprint)
+    if wrapped_eprint is not None:
+        eprint_elem = wrapped_eprint
+
+    lastmod_elem = eprint_elem.find('ep2:lastmod', ns_eprint)
+    if lastmod_elem is None or not lastmod_elem.text:
+        return None
+
+    lastmod_str = lastmod_elem.text.strip()  # "2025-03-19 09:34:42"
+
+    # Convert the timestamp string into a datetime object.
+    ep_timestamp = datetime.strptime(lastmod_str, "%Y-%m-%d %H:%M:%S")
+    adjusted_ep_timestamp = ep_timestamp
+    # TODO: adjusted_ep_timestamp = ep_timestamp + timedelta(hours=1)
+    return adjusted_ep_timestamp.replace(tzinfo=timezone.utc)
+
+
+@profiled
+def get_document_ids(target, epid, experiment_name, yaml_timestamp=None, type='fileid'):
     """
     Gets ids for the files in eprints
     Parameters
     ----------
+    target : dict
+        Server to query, see make_target
     epid : int
         Eprint entry for the current measurements
     yaml_timestamp : date or None
@@ -184,23 +667,20 @@ def get_document_ids(epid, experiment_name, yaml_timestamp=None, type='fileid'):
     """
 
     ns_atom = {'atom': 'http://www.w3.org/2005/Atom'}
-    ns_eprint = {'ep2': 'http://eprints.org/ep2/data/2.0'}
 
     s = requests.Session()
 
     headers_atom_xml = {'Accept': 'application/atom+xml', 'Accept-Charset': 'UTF-8'}
-    url_atom_xml = BASE_URL + "/id/eprint/" + str(epid) + "/contents"
+    base_url = target['base_url']
+    url_atom_xml = base_url + "/id/eprint/" + str(epid) + "/contents"
     headers_eprint_xml = {'Accept': 'application/xml', 'Accept-Charset': 'UTF-8'}
-    url_eprint_xml = f"{BASE_URL}/cgi/export/eprint/{epid}/XMLCit/epub-eprint-{epid}.xml"
+    url_eprint_xml = f"{base_url}/cgi/export/eprint/{epid}/XMLCit/epub-eprint-{epid}.xml"
 
-    if user:
-        r_atom_xml = requests.Request('GET', url_atom_xml, headers=headers_atom_xml, auth=(user, password))
-    else:
-        r_atom_xml = requests.Request('GET', url_atom_xml, headers=headers_atom_xml)
+    r_atom_xml = requests.Request('GET', url_atom_xml, headers=headers_atom_xml, auth=get_auth(target))
 
     prepared_atom_xml = r_atom_xml.prepare()
 
-    response_atom_xml = s.send(prepared_atom_xml, verify=VERIFY)
+    response_atom_xml = s.send(prepared_atom_xml, verify=target['verify'])
 
     logging.debug(response_atom_xml)
     logging.debug(response_atom_xml.status_code)
@@ -208,14 +688,11 @@ def get_document_ids(epid, experiment_name, yaml_timestamp=None, type='fileid'):
     logging.debug(response_atom_xml.headers)
     logging.debug(response_atom_xml.text)
 
-    if user:
-        r_eprint_xml = requests.Request('GET', url_eprint_xml, headers=headers_eprint_xml, auth=(user, password))
-    else:
-        r_eprint_xml = requests.Request('GET', url_eprint_xml, headers=headers_eprint_xml)
+    r_eprint_xml = requests.Request('GET', url_eprint_xml, headers=headers_eprint_xml, auth=get_auth(target))
 
     prepared_eprint_xml = r_eprint_xml.prepare()
 
-    response_eprint_xml = s.send(prepared_eprint_xml, verify=VERIFY)
+    response_eprint_xml = s.send(prepared_eprint_xml, verify=target['verify'])
 
     logging.debug(response_eprint_xml)
     logging.debug(response_eprint_xml.status_code)
@@ -255,16 +732,7 @@ def get_document_ids(epid, experiment_name, yaml_timestamp=None, type='fileid'):
         root_eprint_xml = ET.fromstring(response_eprint_xml.text)
 
         # Find the <lastmod> element using the namespace
-        adjusted_adjusted_ep_timestamp_utc = None
-        lastmod_elem = root_eprint_xml.find('ep2:lastmod', ns_eprint)
-        if lastmod_elem is not None and lastmod_elem.text:
-            lastmod_str = lastmod_elem.text.strip()  # "2025-03-19 09:34:42"
-
-            # Convert the timestamp string into a datetime object.
-            ep_timestamp = datetime.strptime(lastmod_str, "%Y-%m-%d %H:%M:%S")
-            adjusted_ep_timestamp = ep_timestamp
-            # TODO: adjusted_ep_timestamp = ep_timestamp + timedelta(hours=1)
-            adjusted_adjusted_ep_timestamp_utc = adjusted_ep_timestamp.replace(tzinfo=timezone.utc)
+        adjusted_adjusted_ep_timestamp_utc = parse_lastmod(root_eprint_xml)
 
         # Compare timestamps of file with Eprints
         # If equal or yaml is older (lesser than), then no update is needed
@@ -288,12 +756,9 @@ def get_document_ids(epid, experiment_name, yaml_timestamp=None, type='fileid'):
             # Get the id of the document
             if type == 'fileid':
                 # Read file ids; Eprints stores the files with ids, independent of the eprint id
-                url_contents = BASE_URL + "/id/document/" + str(m.group(0)) + "/contents"
+                url_contents = base_url + "/id/document/" + str(m.group(0)) + "/contents"
 
-                if user:
-                    r_contents = requests.Request('GET', url_contents, headers=headers_atom_xml, auth=(user, password))
-                else:
-                    r_contents = requests.Request('GET', url_contents, headers=headers_atom_xml)
+                r_contents = requests.Request('GET', url_contents, headers=headers_atom_xml, auth=get_auth(target))
 
                 prepared_contents = r_contents.prepare()
 
@@ -318,7 +783,7 @@ def get_document_ids(epid, experiment_name, yaml_timestamp=None, type='fileid'):
                 ...
                 """
 
-                single_response = s.send(prepared_contents, verify=VERIFY)
+                single_response = s.send(prepared_contents, verify=target['verify'])
                 if single_response.status_code == 200 or single_response.status_code == 201:
                     if verbose:
                         logging.debug("/documents overview")
@@ -361,23 +826,443 @@ def get_document_ids(epid, experiment_name, yaml_timestamp=None, type='fileid'):
         return False  # Return False if request failed
 
 
-def delete_existing_file(file_id):
+@profiled
+def get_remote_files(target, epid):
+    """
+    Get the files of an eprint with their checksums from a single XML export request.
+
+    Parameters
+    ----------
+    target : dict
+        Server to query, see make_target
+    epid : int
+        Eprint entry for the current measurements
+    Returns
+    -------
+    remote_files : dict or None
+        None on error, else filename -> {'fileid', 'docid', 'hash', 'hash_type', 'filesize'}
+    """
+    s = requests.Session()
+    headers = {'Accept': 'application/xml', 'Accept-Charset': 'UTF-8'}
+    url = f"{target['base_url']}/cgi/export/eprint/{epid}/XML/epub-eprint-{epid}.xml"
+
+    r = requests.Request('GET', url, headers=headers, auth=get_auth(target))
+    prepared = r.prepare()
+    resp = s.send(prepared, verify=target['verify'])
+
+    logging.debug(f"GET {url}")
+
+    if resp.status_code != 200:
+        logging.debug(f"XML export of eprint {epid} failed: {resp.status_code}")
+        return None
+
+    # Every document lists its files like this:
+    """
+    <document>
+      <docid>4853</docid>
+      <files>
+        <file>
+          <fileid>30264</fileid>
+          <filename>wtb_color_01.xml</filename>
+          <hash>3f2a...</hash>
+          <hash_type>MD5</hash_type>
+          <filesize>1234</filesize>
+        </file>
+      </files>
+    </document>
+    """
+    remote_files = parse_remote_files(ET.fromstring(resp.content))
+
+    logging.debug(f"{len(remote_files)} files of eprint {epid} on {target['name']}")
+    return remote_files
+
+
+def parse_remote_files(eprint_elem):
+    """Collect filename -> {'fileid', 'docid', 'hash', 'hash_type', 'filesize'} from an eprint XML element."""
+    ns_eprint = {'ep2': 'http://eprints.org/ep2/data/2.0'}
+
+    remote_files = {}
+    for document in eprint_elem.iter('{http://eprints.org/ep2/data/2.0}document'):
+        docid = document.findtext('ep2:docid', default='', namespaces=ns_eprint).strip()
+        for file_elem in document.iter('{http://eprints.org/ep2/data/2.0}file'):
+            filename = file_elem.findtext('ep2:filename', default='', namespaces=ns_eprint).strip()
+            if not filename:
+                continue
+            filesize = file_elem.findtext('ep2:filesize', default='', namespaces=ns_eprint).strip()
+            remote_files[filename] = {
+                'fileid': file_elem.findtext('ep2:fileid', default='', namespaces=ns_eprint).strip(),
+                'docid': docid,
+                'hash': file_elem.findtext('ep2:hash', default='', namespaces=ns_eprint).strip().lower(),
+                'hash_type': file_elem.findtext('ep2:hash_type', default='', namespaces=ns_eprint).strip().upper(),
+                'filesize': int(filesize) if filesize.isdigit() else None,
+            }
+
+    return remote_files
+
+
+@profiled
+def get_eprint_summaries(target, epids):
+    """
+    Get lastmod and files of many eprints with one search export request per SUMMARY_BATCH_SIZE eprints.
+
+    Parameters
+    ----------
+    target : dict
+        Server to query, see make_target
+    epids : list
+        Eprint ids to look up
+    Returns
+    -------
+    summaries : dict
+        epid (str) -> {'lastmod': datetime or None, 'files': see get_remote_files}.
+        Eprints that are not in the result (not in the live archive yet, or the search export failed)
+        are left out and have to be checked one by one.
+    """
+    ns_eprint = {'ep2': 'http://eprints.org/ep2/data/2.0'}
+
+    s = requests.Session()
+    headers = {'Accept': 'application/xml', 'Accept-Charset': 'UTF-8'}
+    url = f"{target['base_url']}/cgi/search/archive/advanced/export_{REPOSITORY_ID}_XML.xml"
+
+    epids = [str(epid) for epid in epids]
+    summaries = {}
+    for start in range(0, len(epids), SUMMARY_BATCH_SIZE):
+        batch = epids[start:start + SUMMARY_BATCH_SIZE]
+        # Serialized EPrints search expression: any of the eprint ids
+        params = {
+            'screen': 'Search',
+            'dataset': 'archive',
+            '_action_export': '1',
+            'output': 'XML',
+            'exp': '0|1|-date/creators_name/title|archive|-|eprintid:eprintid:ANY:EQ:' + ' '.join(batch) + '|-|',
+            'n': '',
+            'cache': '',
+        }
+
+        r = requests.Request('GET', url, params=params, headers=headers, auth=get_auth(target))
+        prepared = r.prepare()
+        resp = s.send(prepared, verify=target['verify'])
+
+        logging.debug(f"GET {prepared.url}")
+
+        if resp.status_code != 200:
+            logging.debug(f"Search export failed: {resp.status_code}")
+            continue
+
+        try:
+            root_xml = ET.fromstring(resp.content)
+        except ET.ParseError as err:
+            logging.debug(f"Search export is no EPrints XML: {err}")
+            continue
+
+        for eprint in root_xml.iter('{http://eprints.org/ep2/data/2.0}eprint'):
+            epid = eprint.findtext('ep2:eprintid', default='', namespaces=ns_eprint).strip()
+            if epid in batch:
+                summaries[epid] = {
+                    'lastmod': parse_lastmod(eprint),
+                    'files': parse_remote_files(eprint),
+                }
+
+    logging.debug(f"Found {len(summaries)} of {len(epids)} eprints on {target['name']} in one query per "
+                  f"{SUMMARY_BATCH_SIZE}")
+    return summaries
+
+
+def md5_file(file):
+    """Return the MD5 hex digest and size of a file, memory-mapping large files."""
+    size = os.path.getsize(file)
+    md5 = hashlib.md5()
+
+    with open(file, 'rb') as f:
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                md5.update(mapped)
+        else:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                md5.update(chunk)
+
+    return md5.hexdigest(), size
+
+
+@profiled
+def hash_local_files(files):
+    """Hash files in parallel, returns file -> (md5, size). hashlib releases the GIL, so threads are enough."""
+    with ThreadPoolExecutor() as executor:
+        return dict(zip(files, executor.map(md5_file, files)))
+
+
+def is_file_changed(file, local_hashes, remote_files):
+    """Check if the content of a local file differs from the file with the same name on the server."""
+    remote = remote_files.get(os.path.basename(file))
+    if remote is None:
+        return True
+
+    md5, size = local_hashes[file]
+    if remote['filesize'] is not None and remote['filesize'] != size:
+        return True
+    # Only MD5 can be compared locally, files with another hash type are uploaded again
+    return remote['hash_type'] != 'MD5' or remote['hash'] != md5
+
+
+def get_changed_files(experiment, remote_files):
+    """
+    Compare the local checksums of an experiment (see prepare_experiment) with remote_files, without a request.
+
+    Returns whether the index file changed and the set of the other files of the upload queue that changed.
+    """
+    local_hashes = experiment['local_hashes']
+    indexfile = experiment['indexfile']
+
+    upload_index = indexfile not in local_hashes or is_file_changed(indexfile, local_hashes, remote_files)
+    # The index file is uploaded on its own and not again from the queue
+    changed_files = set(entry[-1] for entry in experiment['upload_queue']
+                        if entry[-1] != indexfile and is_file_changed(entry[-1], local_hashes, remote_files))
+    return upload_index, changed_files
+
+
+def are_shards_in_place(experiment, remote_files):
+    """
+    Check from remote_files alone that no file on the server has to move to the document of its resource group.
+
+    That is the case if the files of each group share a document of their own and all other files are in
+    the main document, the one holding the index file. Always true without --shard-by-resource.
+    """
+    resource_groups = experiment['resource_groups']
+    if resource_groups is None:
+        return True
+
+    index = remote_files.get(os.path.basename(experiment['indexfile']))
+    if index is None:
+        return False
+    main_docid = index['docid']
+
+    group_docids = {}
+    for entry in experiment['upload_queue']:
+        filename = os.path.basename(entry[-1])
+        remote = remote_files.get(filename)
+        if remote is None:
+            # Not uploaded yet, that is a change and no move
+            continue
+        group = resource_groups.get(filename)
+        if group is None:
+            if remote['docid'] != main_docid:
+                return False
+        elif remote['docid'] == main_docid or group_docids.setdefault(group, remote['docid']) != remote['docid']:
+            return False
+
+    # Two groups in one document are split up
+    return len(set(group_docids.values())) == len(group_docids)
+
+
+def upload_file(target, file, url, action='POST', compress_level=None, events=None, write_body=None, size=None):
+    """
+    Upload a file with curl_send_file and report its started and finished/failed events, returns the result.
+
+    With write_body the request body is written by write_body(pipe) instead of read from file (see run_curl),
+    size is then the number of bytes reported to the events.
+    """
+    if size is None:
+        size = os.path.getsize(file)
+    if events is not None:
+        events.emit('started', target=target['name'], file=file, bytes=size, url=url)
+
+    start_time = time.monotonic()
+    result = curl_send_file(target, file, url, action=action, compress_level=compress_level, write_body=write_body)
+    duration = round(time.monotonic() - start_time, 3)
+
+    status = get_http_status(result.stdout)
+    if duration >= SLOW_UPLOAD_SECONDS:
+        logging.warning(f"[{target['name']}] Upload of {file} ({format_bytes(size)}) took {duration:.0f} s")
+
+    if events is not None:
+        if result.returncode == 0 and status is not None and status < 400:
+            events.emit('finished', target=target['name'], file=file, bytes=size, duration=duration, status=status,
+                        remote_id=get_remote_id(result.stdout))
+        else:
+            # curl only writes to stderr when the request itself failed, otherwise the server answered with an error
+            if result.returncode != 0 and result.stderr.strip():
+                error = result.stderr.strip().splitlines()[-1]
+            else:
+                error = f"HTTP {status}"
+            events.emit('failed', target=target['name'], file=file, bytes=size, duration=duration, status=status,
+                        error=error)
+
+    return result
+
+
+def delete_existing_file(target, file_id):
     """Delete an existing file from EPrints before re-uploading."""
-    url = BASE_URL + "/id/file/" + str(file_id)
-    headers = {'Authorization': f'Basic {user}:{password}'}
+    url = target['base_url'] + "/id/file/" + str(file_id)
+    headers = {'Authorization': f"Basic {target['user']}:{target['password']}"}
 
-    response = requests.delete(url, headers=headers, verify=VERIFY)
+    response = requests.delete(url, headers=headers, verify=target['verify'])
     if response.status_code == 200 or response.status_code == 204:
         logging.debug(f"Deleted existing file ID {file_id} successfully.")
     else:
         logging.debug(f"Failed to delete file ID {file_id}: {response.status_code} - {response.text}")
 
 
-def get_existing_file_id(epid, filename):
+@profiled
+def get_document_files(target, docid):
+    """Return filename -> file id for all files of a document from its contents feed, or None on error."""
+    ns_atom = {'atom': 'http://www.w3.org/2005/Atom'}
+
+    s = requests.Session()
+    headers = {'Accept': 'application/atom+xml', 'Accept-Charset': 'UTF-8'}
+    url = target['base_url'] + "/id/document/" + str(docid) + "/contents"
+
+    r = requests.Request('GET', url, headers=headers, auth=get_auth(target))
+    prepared = r.prepare()
+    resp = s.send(prepared, verify=target['verify'])
+
+    logging.debug(f"GET {url}")
+
+    if resp.status_code != 200 and resp.status_code != 201:
+        return None
+
+    files = {}
+    root_xml = ET.fromstring(resp.content)
+    for entry in root_xml.findall('atom:entry', ns_atom):
+        title_elem = entry.find('atom:title', ns_atom)
+        id_elem = entry.find('atom:id', ns_atom)
+        if title_elem is not None and title_elem.text and id_elem is not None and id_elem.text:
+            # The file id is the last segment of https://.../id/file/30264
+            files[title_elem.text.strip()] = id_elem.text.strip().split('/')[-1]
+
+    return files
+
+
+def get_eprint_documents(target, epid):
+    """
+    Return the ids of all documents of an eprint, whatever their format, in the order of its contents feed.
+
+    Returns None on error, an empty list would look like an eprint without documents.
+    """
+    ns_atom = {'atom': 'http://www.w3.org/2005/Atom'}
+
+    s = requests.Session()
+    headers = {'Accept': 'application/atom+xml', 'Accept-Charset': 'UTF-8'}
+    url = target['base_url'] + "/id/eprint/" + str(epid) + "/contents"
+
+    r = requests.Request('GET', url, headers=headers, auth=get_auth(target))
+    prepared = r.prepare()
+    resp = s.send(prepared, verify=target['verify'])
+
+    logging.debug(f"GET {url}")
+
+    if resp.status_code != 200 and resp.status_code != 201:
+        logging.debug(f"Documents of eprint {epid} could not be listed: {resp.status_code}")
+        return None
+
+    docids = []
+    root_xml = ET.fromstring(resp.content)
+    for entry in root_xml.findall('atom:entry', ns_atom):
+        id_elem = entry.find('atom:id', ns_atom)
+        if id_elem is not None and id_elem.text and '/document/' in id_elem.text:
+            docids.append(id_elem.text.strip().split('/')[-1])
+
+    return docids
+
+
+def get_resource_groups(doc):
+    """Map the file names listed under resources[*].data in the YAML to the name of their resource group."""
+    groups = {}
+    for resource in doc.get('resources') or []:
+        for data_file in resource.get('data') or []:
+            groups[os.path.basename(str(data_file))] = str(resource['name'])
+    return groups
+
+
+def find_manifest_yaml(path):
+    """Return the YAML file in the top level of the experiment directory without crawling subdirectories."""
+    yamlfiles = sorted(entry.path for entry in os.scandir(path) if entry.is_file() and entry.name.endswith(".yml"))
+    if len(yamlfiles) > 1:
+        logging.warning(f"More than one YAML file found, using {yamlfiles[-1]}")
+    return yamlfiles[-1] if yamlfiles else ""
+
+
+def resolve_manifest(doc, yamlfile, path):
+    """
+    Resolve the files to upload from the YAML instead of walking the directory tree.
+
+    The upload set is the YAML file, the HTML reports in the top level of path and the files listed
+    under resources[*].data, relative to the directory of the YAML file.
+    Returns the os.stat results of the existing files and the list of listed files that are missing.
+    """
+    data_path = os.path.dirname(yamlfile)
+
+    candidates = [yamlfile]
+    candidates += sorted(entry.path for entry in os.scandir(path) if entry.is_file() and entry.name.endswith(".html"))
+    for resource in doc.get('resources') or []:
+        for data_file in resource.get('data') or []:
+            candidates.append(os.path.join(data_path, str(data_file)))
+
+    stats = {}
+    missing = []
+    for file in candidates:
+        if file in stats:
+            continue
+        try:
+            stats[file] = os.stat(file)
+        except FileNotFoundError:
+            missing.append(file)
+
+    return stats, missing
+
+
+def find_shard_documents(target, epid, main_docid, resource_groups):
+    """
+    Find the document holding each resource group when files are sharded with --shard-by-resource.
+
+    A document belongs to the group of the first of its files that is listed in the YAML.
+    Returns group name -> docid, groups without a document yet are missing.
+    """
+    docids = get_eprint_documents(target, epid)
+    if docids is None:
+        # Without the list every group would get a new document
+        raise RuntimeError(f"Documents of eprint {epid} could not be listed on {target['name']}")
+
+    shard_docids = {}
+    for docid in docids:
+        if docid == main_docid:
+            continue
+        for filename in get_document_files(target, docid) or {}:
+            group = resource_groups.get(filename)
+            if group is not None:
+                shard_docids.setdefault(group, docid)
+                break
+
+    logging.debug(f"Documents of the resource groups on {target['name']}: {shard_docids}")
+    return shard_docids
+
+
+def create_shard_document(target, epid, file, compress_level=None, events=None):
+    """
+    Create a new document by uploading its first file to the eprint, returns the new docid or None.
+
+    The new document is the one missing from the list before the upload, so the upload is not even
+    attempted if the documents cannot be listed.
+    """
+    known_docids = get_eprint_documents(target, epid)
+    if known_docids is None:
+        raise RuntimeError(f"Documents of eprint {epid} could not be listed on {target['name']}")
+
+    curl_target = target['base_url'] + "/id/eprint/" + str(epid) + "/contents"
+    upload_file(target, file, curl_target, action='POST', compress_level=compress_level, events=events)
+
+    for docid in get_eprint_documents(target, epid) or []:
+        if docid not in known_docids:
+            return docid
+    return None
+
+
+@profiled
+def get_existing_file_id(target, epid, filename):
     """
     Check if a file with the same name already exists on the EPrints server.
 
     Parameters:
+    - target (dict): The server to query, see make_target.
     - epid (int): The EPrints entry ID.
     - filename (str): The name of the file to check.
 
@@ -386,15 +1271,12 @@ def get_existing_file_id(epid, filename):
     """
     s = requests.Session()
     headers = {'Accept': 'application/atom+xml', 'Accept-Charset': 'UTF-8'}
-    url = f"{BASE_URL}/id/eprint/{epid}/contents"
+    url = f"{target['base_url']}/id/eprint/{epid}/contents"
 
-    if user:
-        r = requests.Request('GET', url, headers=headers, auth=(user, password))
-    else:
-        r = requests.Request('GET', url, headers=headers)
+    r = requests.Request('GET', url, headers=headers, auth=get_auth(target))
 
     prepared = r.prepare()
-    resp = s.send(prepared, verify=VERIFY)
+    resp = s.send(prepared, verify=target['verify'])
 
     logging.debug(f"GET {url}")
     # logging.debug(resp.text)
@@ -426,16 +1308,13 @@ def get_existing_file_id(epid, filename):
             return None
 
         # Read file ids; Eprints stores the files with ids, independent of the eprint id
-        url = BASE_URL + "/id/document/" + str(document_id) + "/contents"
+        url = target['base_url'] + "/id/document/" + str(document_id) + "/contents"
 
-        if user:
-            r = requests.Request('GET', url, headers=headers, auth=(user, password))
-        else:
-            r = requests.Request('GET', url, headers=headers)
+        r = requests.Request('GET', url, headers=headers, auth=get_auth(target))
 
         prepared = r.prepare()
 
-        single_response = s.send(prepared, verify=VERIFY)
+        single_response = s.send(prepared, verify=target['verify'])
 
         # logging.debug(single_response.text)
 
@@ -463,46 +1342,216 @@ def get_existing_file_id(epid, filename):
     return None  # Return None if no match is found
 
 
-def create_zips(path):
-    """Create zip files for XML and PDF content."""
-    xmlzip = zipfile.ZipFile(path + 'xml.zip', 'w', ZIP_DEFLATED)
-    pdfzip = zipfile.ZipFile(path + 'pdf.zip', 'w', ZIP_DEFLATED)
+def get_zip_members(path):
+    """
+    Collect the members of the archives in ZIP_ARCHIVES from an experiment directory.
+
+    Returns the YAML file and archive name -> sorted list of (file, name in the archive),
+    the YAML file is part of every archive.
+    """
     yamlfile = None
+    members = {archive: [] for archive in ZIP_ARCHIVES}
     for root, dirs, files in os.walk(path):
         for file in files:
             filename, extension = os.path.splitext(file)
-            basename = filename + extension
 
-            if extension in '.xml':
-                xmlzip.write(os.path.join(root, file), file)
-            elif extension in '.pdf':
-                pdfzip.write(os.path.join(root, file), file)
-            elif extension in '.yml':
+            if extension == '.yml':
                 # TODO: throw error when more than one yaml file present
                 yamlfile = os.path.join(root, file)
-                xmlzip.write(os.path.join(root, file), file)
-                pdfzip.write(os.path.join(root, file), file)
+            for archive, extensions in ZIP_ARCHIVES.items():
+                if extension in extensions or extension == '.yml':
+                    members[archive].append((os.path.join(root, file), file))
+
+    # A stable order keeps unchanged archives byte for byte identical
+    for archive in members:
+        members[archive].sort(key=lambda member: (member[1], member[0]))
+
+    return yamlfile, members
+
+
+def deflate_file(file, level):
+    """Compress a file to a raw deflate stream as stored in zip archives, returns (crc, size, data)."""
+    # Negative wbits write no zlib header and trailer. zlib releases the GIL, so files compress in parallel threads
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    chunks = []
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(COMPRESS_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    return crc, size, b''.join(chunks)
+
+
+def read_zip_entries(archive, level):
+    """
+    Return name -> ZipInfo of the entries of an archive written by write_zip with the same level.
+
+    Entries of other archives or levels cannot be reused, so an empty dict is returned for them.
+    """
+    if not archive or not os.path.isfile(archive):
+        return {}
+    try:
+        with zipfile.ZipFile(archive) as zf:
+            if zf.comment != f"level={level}".encode():
+                return {}
+            return {info.filename: info for info in zf.infolist()}
+    except (zipfile.BadZipFile, OSError) as err:
+        logging.debug(f"Previous archive {archive} cannot be reused: {err}")
+        return {}
 
-    xmlzip.close()
-    pdfzip.close()
 
-    return [yamlfile, xmlzip.filename, pdfzip.filename]
+def read_raw_zip_entry(f, info):
+    """Read the compressed data of an entry from the open archive f, without decompressing it."""
+    f.seek(info.header_offset)
+    header = f.read(30)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    f.seek(info.header_offset + 30 + name_length + extra_length)
+    return f.read(info.compress_size)
 
 
-def create_ep_xml_file(xmlcontent):
-    """Create XML file for the EPrint metadata."""
-    filename = 'ep_metadata.xml'
-    stream = open(filename, 'w')
+def get_dos_time(mtime):
+    """Return the (time, date) fields of a zip header for a modification time."""
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
 
-    # Python 3 needs byte streams whereas python 3 needs a str
-    # For this to work in python 2 encode it as utf8
-    stream.write(xmlcontent)
-    stream.close()
 
-    return filename
+def write_zip(stream, members, level=DEFAULT_COMPRESS_LEVEL, previous=None):
+    """
+    Write a zip archive of members [(file, name in the archive)] to stream, returns the number of reused entries.
+
+    The members are compressed in parallel by ZIP_WORKERS threads and written in order as they are done,
+    so stream may be a pipe, e.g. into an upload. Entries of the previous archive (see read_zip_entries)
+    are copied without compressing again if the file still has the same size and modification time.
+    The archive comment holds the level and the entry comments the modification time in ns, to check that.
+    """
+    previous_entries = read_zip_entries(previous, level)
+    previous_file = open(previous, 'rb') if previous_entries else None
+
+    def get_entry(file, name, stat):
+        """(crc, size, data) of a member, from the previous archive if it is unchanged."""
+        info = previous_entries.get(name)
+        if (info is not None and info.file_size == stat.st_size and info.compress_type == ZIP_DEFLATED
+                and info.comment == str(stat.st_mtime_ns).encode()):
+            return info.CRC, info.file_size, read_raw_zip_entry(previous_file, info)
+        return None
+
+    central_directory = []
+    offset = 0
+    reused = 0
+    try:
+        with ThreadPoolExecutor(max_workers=ZIP_WORKERS) as executor:
+            # Only a few members are compressed ahead of the writer, so the memory stays bounded
+            pending = deque()
+            member_iter = iter(members)
+
+            def submit_next():
+                for file, name in member_iter:
+                    stat = os.stat(file)
+                    entry = get_entry(file, name, stat)
+                    if entry is not None:
+                        pending.append((name, stat, entry, None))
+                    else:
+                        pending.append((name, stat, None, executor.submit(deflate_file, file, level)))
+                    return True
+                return False
+
+            while len(pending) < 2 * ZIP_WORKERS and submit_next():
+                pass
+
+            while pending:
+                name, stat, entry, future = pending.popleft()
+                submit_next()
+                if entry is not None:
+                    reused += 1
+                else:
+                    entry = future.result()
+                crc, size, data = entry
+
+                if offset + len(data) >= zipfile.ZIP64_LIMIT or len(central_directory) >= zipfile.ZIP_FILECOUNT_LIMIT:
+                    raise zipfile.LargeZipFile(f"{name} does not fit into a zip archive without ZIP64")
+
+                encoded_name = name.encode('utf-8')
+                # Bit 11: the name is UTF-8
+                flags = 0x800 if not name.isascii() else 0
+                dos_time, dos_date = get_dos_time(stat.st_mtime)
+                comment = str(stat.st_mtime_ns).encode()
+                fields = struct.pack('<HHHHIII', flags, ZIP_DEFLATED, dos_time, dos_date, crc, len(data), size)
+
+                stream.write(struct.pack('<IH', 0x04034b50, 20) + fields + struct.pack('<HH', len(encoded_name), 0))
+                stream.write(encoded_name)
+                stream.write(data)
+
+                central_directory.append(
+                    struct.pack('<IHH', 0x02014b50, 20, 20) + fields
+                    + struct.pack('<HHHHHII', len(encoded_name), 0, len(comment), 0, 0, 0, offset)
+                    + encoded_name + comment)
+                offset += 30 + len(encoded_name) + len(data)
+    finally:
+        if previous_file is not None:
+            previous_file.close()
+
+    directory = b''.join(central_directory)
+    archive_comment = f"level={level}".encode()
+    stream.write(directory)
+    stream.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(central_directory), len(central_directory),
+                             len(directory), offset, len(archive_comment)))
+    stream.write(archive_comment)
+
+    return reused
+
+
+def is_zip_unchanged(archive, members, level):
+    """True if archive was written by write_zip from exactly these members, unchanged since."""
+    entries = read_zip_entries(archive, level)
+    if len(entries) != len(members) or len(set(name for file, name in members)) != len(members):
+        return False
+    for file, name in members:
+        info = entries.get(name)
+        stat = os.stat(file)
+        if info is None or info.file_size != stat.st_size or info.comment != str(stat.st_mtime_ns).encode():
+            return False
+    return True
+
+
+@profiled
+def create_zips(path, level=DEFAULT_COMPRESS_LEVEL):
+    """
+    Create zip files for XML and PDF content in the experiment directory.
+
+    Unchanged archives are left as they are, so their checksum and modification time stay the same.
+    Otherwise the archive is rebuilt with write_zip, reusing the entries of unchanged files.
+    Returns the YAML file and the paths of the archives that have members.
+    """
+    yamlfile, members = get_zip_members(path)
+
+    archives = []
+    for archive, archive_members in members.items():
+        archive_path = os.path.join(path, archive)
+        # An archive of only the YAML file is not worth uploading
+        if len(archive_members) <= (1 if yamlfile else 0):
+            continue
+        archives.append(archive_path)
+
+        if is_zip_unchanged(archive_path, archive_members, level):
+            logging.debug(f"{archive_path} is up to date")
+            continue
+
+        # Written next to the previous archive first, so its entries can be reused
+        temp_path = archive_path + '.tmp'
+        with open(temp_path, 'wb') as stream:
+            reused = write_zip(stream, archive_members, level, previous=archive_path)
+        os.replace(temp_path, archive_path)
+        logging.debug(f"Created {archive_path} with {len(archive_members)} files, {reused} reused")
 
+    return [yamlfile] + archives
 
-def create_ep_xml_schema(doc):
+
+def create_ep_xml_schema(doc, nds):
     # Extract metadata from the YAML file
     experiment = doc['experiment']
     title = experiment['title']
@@ -517,7 +1566,6 @@ def create_ep_xml_schema(doc):
     first_name = author['firstName']
     last_name = author['lastName']
     orcid = author['id']
-    nds = user
     publication_date = time.strftime("%Y-%m-%d")
     date_type = "published"
 
@@ -648,180 +1696,399 @@ def load_netrc():
             return None
 
 
-# remove files after upload
-def cleanup():
-    try:
-        # TODO: Do get files removed if one file couldn't be found?
-        os.remove(ep_xml_file)
-    except IOError:
-        pass
-
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Eprits SWORD client')
-    parser.add_argument('--path', '-p', type=str, help='Directory for uploading')
-    parser.add_argument('--epid', '-i', type=int,
-                        help='Eprints Id to append or false to create new entry')
-    parser.add_argument('--user', '-u', type=str, help='Eprints username')
-    parser.add_argument('--verbose', '-v', action='store_true', help='Show additional information')
-    parser.add_argument('--force', action='store_true', help='Force update')
-    parser.add_argument("--auto", action="store_true", help="Run without user interaction")
-
-    args = parser.parse_args()
-
-    path = args.path
-    epid = args.epid
-    user = args.user
-    verbose = args.verbose
-    force = args.force
-
-    logging.basicConfig(
-        level=logging.DEBUG if verbose else logging.INFO,
-        format='%(asctime)s %(levelname)s: %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-
-    if verbose:
-        logging.getLogger().setLevel(logging.DEBUG)
-    else:
-        logging.getLogger().setLevel(logging.INFO)
-
-    # If no path set, read from cmd
-    if path is None:
-        path = input("File/Directory: ")
-
-    # File or folder exist?
-    assert os.path.exists(path), "Path not found: " + str(path)
-    assert os.path.isdir(path), "No valid directory path " + str(path)
-
-    from os.path import expanduser
-
-    # Get the user's home directory
-    home = expanduser("~")
-
-    # Load netrc for authentication
-    net = load_netrc()
-
+def load_target(name, user, net):
+    """Create the target for a server with the credentials from netrc, prompting for a password if needed."""
+    host = urlsplit(SERVERS[name]).netloc
     password = None
 
     if user is None and net:
         try:
-            (user, account, password) = net.authenticators(BASE_URL[8:])
-            logging.debug(f"User for {BASE_URL[8:]}: {user}")
+            (user, account, password) = net.authenticators(host)
+            logging.debug(f"User for {host}: {user}")
         except:
-            logging.debug(f"Error with {BASE_URL[8:]}: {sys.exc_info()[0]}")
+            logging.debug(f"Error with {host}: {sys.exc_info()[0]}")
             user = False
     else:
         user = False
 
-    # No eprint id provided via args
-    if epid is None:
-        epid = False
-
     # User password
     # only prompt for password if a user is provided
     # curl and python.requests should attempt to use netrc instead
     # they will try to use .netrc (linux) or _netrc from the users home directory
     # The file should look like this machine <example.com> login <username> password <password>
     if user and password is None:
-        password = getpass.getpass('Password:')
+        password = getpass.getpass(f'Password for {host}:')
 
-    yamlfile = ""
-    # Look for the YAML file in the directory
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            filename, extension = os.path.splitext(file)
-            basename = filename + extension
-            if file.endswith(".yml"):
-                yamlfile = os.path.join(root, file)
+    return make_target(name, user, password)
 
-    if verbose:
-        logging.debug(f"YAML file located at {yamlfile}")
 
-    yaml_mtime = os.path.getmtime(yamlfile)
-    # First, get the file modification time as a naive datetime in local time:
-    local_dt = datetime.fromtimestamp(yaml_mtime)
-    # Then, convert it to a timezone-aware datetime in UTC:
-    yaml_timestamp = local_dt.astimezone(timezone.utc)
+def append_epid(yamlfile, key, epid):
+    """Write the id of a newly created eprint into the YAML file unless it is already there."""
+    with yaml_lock:
+        # Update yamlfile stream
+        stream = open(yamlfile, "r")
+        doc = yaml.safe_load(stream)
+        stream.close()
 
-    logging.debug(f"Local YAML file was last changed at {yaml_timestamp}")
+        # If new eprint was generated, update the yamlfile with its id
+        if not (key in doc.keys()):
+            yaml_file = open(yamlfile, 'a')  # append to file
+            yaml_file.write("\n" + key + ": " + epid)
+            yaml_file.close()
+            # Read as yamlfile and write as plain text because pyyaml messes up the structure
 
-    # Open yaml file
-    stream = open(yamlfile, "r")
-    doc = yaml.safe_load(stream)
 
-    # TODO: What does this do?
-    # Read and write finished flag
-    if 'finished' in doc.keys():
-        logging.info("Experiment completed!")
-        cleanup()
-        exit()
+@profiled
+def sync_target(target, experiment, compress_level=None, summary=None, events=None):
+    """
+    Synchronize one locally scanned experiment (see prepare_experiment) with one server.
 
-    docids = None
-    if 'epid' in doc.keys():
-        epid = doc['epid']
+    Everything that only depends on the local files (YAML, upload queue) is prepared once by the caller,
+    everything that depends on the server (eprint id, document ids, credentials) is handled here.
+    The upload queue is copied, so it can be shared between targets.
 
-        if not args.auto:
-            response = input("Please check if the eprint id is associated with the correct entry. Do you want to "
-                             "proceed? (y/n): ").strip().lower()
-            if response != "y":
-                logging.info("Exiting ...")
-                sys.exit(1)
+    If the experiment has local_hashes (see hash_local_files), the files are compared with the checksums on the
+    server instead of comparing the YAML modification time, and only files with different content are uploaded.
 
-    experiment_name = doc['experiment']['name']
-    ep_xml = create_ep_xml_schema(doc)
+    If the experiment has zip_members (see get_zip_members), the archives are built while uploading them
+    into the main document, after the other files.
 
-    # YAML file was read
-    stream.close()
+    If the experiment has resource_groups (see get_resource_groups), the files of each resource group are kept in
+    a document of their own instead of the main document, so no document grows with the whole experiment.
 
-    ep_xml_file = create_ep_xml_file(ep_xml)
+    If the experiment has force set (--force), all files are uploaded, whatever the timestamps or checksums say.
+
+    summary is the state of the eprint from get_eprint_summaries, if it was found there.
+    Every upload is reported to events (see UploadEvents), if given.
+    """
+    name = target['name']
+    base_url = target['base_url']
+
+    epid = experiment['epids'][name]
+    experiment_name = experiment['experiment_name']
+    yamlfile = experiment['yamlfile']
+    yaml_timestamp = experiment['yaml_timestamp']
+    indexfile = experiment['indexfile']
+    local_hashes = experiment['local_hashes']
+    resource_groups = experiment['resource_groups']
+    force = experiment['force']
 
     if not epid:
         headers = {}
         headers.update({'Content-Type': 'application/vnd.eprints.data+xml'})
         # If no EPrint ID, create a new EPrint entry
-        data = open(ep_xml_file, 'rb').read()
-        epid = send_sword_request(data, content_type='application/vnd.eprints.data+xml', send_file=False,
+        # The metadata is sent from memory, a shared ep_metadata file would be overwritten by other
+        # processes syncing to the same target (see --drain)
+        data = experiment['ep_xml'][name].encode('utf-8')
+        epid = send_sword_request(target, data, content_type='application/vnd.eprints.data+xml', send_file=False,
                                   headers=headers)
 
         m = re.search('[0-9]+$', str(epid))
         epid = m.group(0)
 
-        logging.debug(f"Eprint with id {epid} was created")
+        logging.info(f"[{name}] Eprint with id {epid} was created")
 
         # Fetch document IDs of newly created entry
         # Pass no timestamp as it was newly created
-        docids = get_document_ids(int(epid), experiment_name, yaml_timestamp=None)
+        docids = get_document_ids(target, int(epid), experiment_name, yaml_timestamp=None)
+
+        append_epid(yamlfile, get_epid_key(target), epid)
+    elif summary is not None:
+        # The eprint was already checked with the other eprints in one request
+        if not force and local_hashes is None and summary['lastmod'] and summary['lastmod'] >= yaml_timestamp:
+            logging.info(f"[{name}] Files of {experiment_name} already up to date")
+            return
+
+        # The checksums of the summary decide as well, before any request for this eprint
+        if local_hashes is not None:
+            upload_index, changed_files = get_changed_files(experiment, summary['files'])
+            if not upload_index and not changed_files and are_shards_in_place(experiment, summary['files']):
+                logging.info(f"[{name}] Files of {experiment_name} already up to date")
+                return
+
+        docids = get_document_ids(target, int(epid), experiment_name, yaml_timestamp=None, type='fileid')
     else:
         # Eprint entry already exists, so get the file ids of the main html files
         # The ids of the main html files (if more uploaded packages are available)
-        docids = get_document_ids(int(epid), experiment_name, yaml_timestamp, type='fileid')
+        # With checksums the content decides what is up to date, not the timestamp, --force uploads anyway
+        docids = get_document_ids(target, int(epid), experiment_name,
+                                  None if local_hashes is not None or force else yaml_timestamp, type='fileid')
 
-        logging.debug(f"Eprint with id {str(epid)} will be updated")
+        logging.debug(f"Eprint with id {str(epid)} will be updated on {name}")
 
     logging.debug("The docids are the following:")
     logging.debug(docids)
 
-    # Update yamlfile stream
+    if docids and docids == -1:
+        logging.info(f"[{name}] Files already up to date")
+        return
+
+    if not os.path.isfile(indexfile):
+        logging.info("HTML file doesn't exist")
+        return
+
+    queue = list(experiment['upload_queue'])
+    remote_files = None
+    if local_hashes is not None and summary is not None:
+        remote_files = summary['files']
+    elif local_hashes is not None:
+        remote_files = get_remote_files(target, epid)
+        if remote_files is None:
+            logging.warning(f"[{name}] Checksums could not be fetched, uploading all files")
+
+    upload_index = True
+    changed_files = None
+    if remote_files is not None:
+        upload_index, changed_files = get_changed_files(experiment, remote_files)
+
+        if not upload_index and not changed_files and are_shards_in_place(experiment, remote_files):
+            logging.info(f"[{name}] Files already up to date")
+            return
+
+    if upload_index and events is not None:
+        events.emit('queued', target=name, file=indexfile, bytes=os.path.getsize(indexfile))
+
+    if not upload_index:
+        logging.debug("Index file is unchanged")
+    elif docids and len(docids) >= 1:
+        # Main HTML file will be updated
+        logging.debug("Add files to an existing entry")
+        curl_target = base_url + "/id/file/" + str(docids[0])
+        logging.debug(f"Target url: {curl_target}")
+
+        upload_file(target, indexfile, curl_target, action='PUT', compress_level=compress_level, events=events)
+    else:
+        curl_target = base_url + "/id/eprint/" + str(epid) + "/contents"
+        logging.debug(f"Adding files to a new entry {epid}")
+        logging.debug(f"File tu upload: {indexfile}")
+        logging.debug(f"Target url: {curl_target}")
+
+        upload_file(target, indexfile, curl_target, action='POST', compress_level=compress_level, events=events)
+
+    # Fetch the main document ID after the first upload
+    response = get_document_ids(target, epid, experiment_name, yaml_timestamp=None, type='document')
+
+    logging.debug("Response of first upload")
+    logging.debug(response)
+
+    docid = False
+    if response and len(response) > 0:
+        docid = response[0]
+        logging.debug(f"Docid {docid} was request")
+    else:
+        logging.debug("No docid could be requested")
+        return
+
+    shard_docids = {}
+    # docid -> {filename: file id}, filled on first use
+    document_files = {}
+    if resource_groups is not None:
+        shard_docids = find_shard_documents(target, epid, docid, resource_groups)
+
+    def get_file_docid(experiment_file):
+        """Document a file belongs in, None if its resource group has no document yet."""
+        group = resource_groups.get(os.path.basename(experiment_file)) if resource_groups is not None else None
+        if group is None:
+            return docid
+        return shard_docids.get(group)
+
+    if changed_files is not None:
+        # Unchanged files still move when they are not in the document of their resource group
+        queue = [entry for entry in queue
+                 if entry[-1] in changed_files
+                 or (entry[-1] != indexfile
+                     and remote_files[os.path.basename(entry[-1])]['docid'] != get_file_docid(entry[-1]))]
+        heapq.heapify(queue)
+
+        if not queue:
+            logging.info(f"[{name}] Files already up to date")
+            return
+
+    total_files = len(queue)
+    logging.info(f"[{name}] Total files to upload: {total_files}")
+
+    if events is not None:
+        for priority, size, mtime, experiment_file in sorted(queue):
+            events.emit('queued', target=name, file=experiment_file, bytes=size)
+
+    while queue:
+        # Most important files first, see build_upload_queue
+        experiment_file = heapq.heappop(queue)[-1]
+        filename, extension = os.path.splitext(experiment_file)
+
+        action = "POST"
+
+        file_docid = get_file_docid(experiment_file)
+
+        # Check if the file already exists on the server
+        if remote_files is not None:
+            existing_file_id = remote_files.get(os.path.basename(experiment_file), {}).get('fileid')
+        elif resource_groups is not None:
+            # The file lists of the documents are bounded and fetched once per run. Look in the
+            # file's own document first, files of a group that is not sharded yet are in the main document
+            existing_file_id = None
+            for lookup_docid in [file_docid, docid]:
+                if lookup_docid is None:
+                    continue
+                if lookup_docid not in document_files:
+                    document_files[lookup_docid] = get_document_files(target, lookup_docid) or {}
+                existing_file_id = document_files[lookup_docid].get(os.path.basename(experiment_file))
+                if existing_file_id:
+                    break
+        else:
+            existing_file_id = get_existing_file_id(target, epid, os.path.basename(experiment_file))
+        if existing_file_id:
+            # action = "PUT"
+            logging.debug(f"File with id {existing_file_id} already exists!")
+            # If file exists, delete it first before re-uploading
+            delete_existing_file(target, existing_file_id)
+
+        # if experiment_file != indexfile:
+        if verbose:
+            logging.debug(f"Attempt to upload {filename}.{extension}")
+
+        if file_docid is None:
+            # First file of a resource group, the upload creates the group's document
+            group = resource_groups[os.path.basename(experiment_file)]
+            logging.debug(f"Create document for resource group {group}")
+            file_docid = create_shard_document(target, epid, experiment_file, compress_level, events)
+            if file_docid is None:
+                # Every further attempt could create one more document, the rest of the group goes into
+                # the main document and is moved on a later run
+                logging.warning(f"[{name}] Document for resource group {group} could not be created, "
+                                "using the main document")
+                file_docid = docid
+            shard_docids[group] = file_docid
+        else:
+            curl_target = base_url + "/id/document/" + str(file_docid) + "/contents"
+
+            logging.debug(f"Send to {curl_target} via {action}")
+
+            upload_file(target, experiment_file, curl_target, action=action, compress_level=compress_level,
+                        events=events)
+
+    # Streamed archives have no local checksum, they are sent whenever any file changed
+    for archive, members in (experiment['zip_members'] or {}).items():
+        # Checked before the archive on the server is deleted, so it stays if the new one cannot be built.
+        # The archive size is only known at the end, the events count the size of its members
+        try:
+            size = 0
+            for file, member_name in members:
+                with open(file, 'rb'):
+                    size += os.path.getsize(file)
+        except OSError as err:
+            logging.warning(f"[{name}] {archive} is not uploaded, a file cannot be read: {err}")
+            if events is not None:
+                events.emit('queued', target=name, file=archive, bytes=0)
+                events.emit('failed', target=name, file=archive, bytes=0, error=f"{type(err).__name__}: {err}")
+            continue
+
+        if events is not None:
+            events.emit('queued', target=name, file=archive, bytes=size)
+
+        if remote_files is not None:
+            existing_file_id = remote_files.get(archive, {}).get('fileid')
+        else:
+            existing_file_id = get_existing_file_id(target, epid, archive)
+        if existing_file_id:
+            delete_existing_file(target, existing_file_id)
+        curl_target = base_url + "/id/document/" + str(docid) + "/contents"
+        logging.debug(f"Stream {archive} to {curl_target}")
+        upload_file(target, archive, curl_target, events=events, size=size,
+                    write_body=functools.partial(write_zip, members=members, level=experiment['zip_level']))
+
+    logging.info(f"[{name}] Upload finished")
+
+
+def sync_experiments(target, experiments, compress_level=None, events=None):
+    """
+    Synchronize all experiments with one server, one after another.
+
+    The state of all existing eprints is fetched up front with get_eprint_summaries, so experiments that
+    are up to date cost no further request. Returns False if any experiment failed.
+    """
+    name = target['name']
+    epids = [experiment['epids'][name] for experiment in experiments if experiment['epids'][name]]
+    summaries = get_eprint_summaries(target, epids) if epids else {}
+
+    success = True
+    for experiment in experiments:
+        summary = summaries.get(str(experiment['epids'][name]))
+        try:
+            sync_target(target, experiment, compress_level, summary, events)
+        except Exception as err:
+            logging.error(f"[{name}] Synchronization of {experiment['path']} failed: {err}")
+            success = False
+
+    return success
+
+
+@profiled
+def prepare_experiment(path, args, targets):
+    """
+    Do all the local work for an experiment directory once, for all targets.
+
+    Returns a dict with the parsed YAML, the eprint id and metadata per target, the upload queue and
+    the optional checksums, resource groups and members of the streamed archives, or None if the experiment
+    is finished.
+    """
+    yamlfile = ""
+    if args.manifest:
+        yamlfile = find_manifest_yaml(path)
+    else:
+        # Look for the YAML file in the directory
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                filename, extension = os.path.splitext(file)
+                basename = filename + extension
+                if file.endswith(".yml"):
+                    yamlfile = os.path.join(root, file)
+
+    if verbose:
+        logging.debug(f"YAML file located at {yamlfile}")
+
+    yaml_mtime = os.path.getmtime(yamlfile)
+    # First, get the file modification time as a naive datetime in local time:
+    local_dt = datetime.fromtimestamp(yaml_mtime)
+    # Then, convert it to a timezone-aware datetime in UTC:
+    yaml_timestamp = local_dt.astimezone(timezone.utc)
+
+    logging.debug(f"Local YAML file was last changed at {yaml_timestamp}")
+
+    # Open yaml file
     stream = open(yamlfile, "r")
     doc = yaml.safe_load(stream)
+
+    # YAML file was read
     stream.close()
 
-    # If new eprint was generated, update the yamlfile with its id
-    if not ('epid' in doc.keys()):
-        yaml_file = open(yamlfile, 'a')  # append to file
-        yaml_file.write("\n" + "epid: " + epid)
-        yaml_file.close()
-        # Read as yamlfile and write as plain text because pyyaml messes up the structure
+    # TODO: What does this do?
+    # Read and write finished flag
+    if 'finished' in doc.keys():
+        logging.info(f"Experiment completed! ({path})")
+        return None
 
-    url = ''
+    # Eprint id of every target, False to create a new entry
+    epids = {}
+    for target in targets:
+        epids[target['name']] = get_epid(doc, target) or args.epid or False
 
-    if docids and docids == -1:
-        logging.info("Files already up to date")
-        cleanup()
-        exit()
+    if any(get_epid(doc, target) for target in targets) and not args.auto:
+        response = input(f"Please check if the eprint id of {path} is associated with the correct entry. "
+                         "Do you want to proceed? (y/n): ").strip().lower()
+        if response != "y":
+            logging.info("Exiting ...")
+            sys.exit(1)
+
+    experiment_name = doc['experiment']['name']
 
-    thisurl = BASE_URL + "/id/eprint/" + str(epid) + "/contents"
+    # The metadata contains the user of the target as creator id
+    ep_xml = {}
+    for target in targets:
+        ep_xml[target['name']] = create_ep_xml_schema(doc, target['user'])
+
+    # Data files of each resource group, when every group gets its own document
+    resource_groups = get_resource_groups(doc) if args.shard_by_resource else None
 
     # Upload all htmlfiles
     htmlpath = path  # + "/evaluations/" oder '/opt/DTSevaluations/example data/colorlearning/evaluations/'
@@ -831,84 +2098,495 @@ if __name__ == "__main__":
     indexfile = os.path.join(htmlpath, experiment_name + ".html")
     logging.debug(f"Index file is {indexfile}")
 
-    if os.path.isfile(indexfile):
-        if docids and len(docids) >= 1:
-            # Main HTML file will be updated
-            logging.debug("Add files to an existing entry")
-            curl_target = BASE_URL + "/id/file/" + str(docids[0])
-            logging.debug(f"Target url: {curl_target}")
+    # Collect all files that need to process, once for all targets
+    files_to_upload = []
+    file_stats = None
+    if args.manifest:
+        file_stats, missing_files = resolve_manifest(doc, yamlfile, path)
+        files_to_upload = list(file_stats)
+        if missing_files:
+            logging.warning(f"{len(missing_files)} files listed in {os.path.basename(yamlfile)} are missing:")
+            for missing_file in missing_files:
+                logging.warning(f"  {missing_file}")
+    else:
+        for root, dirs, files in os.walk(path):
+            for experiment_file in files:
+                filename, extension = os.path.splitext(experiment_file)
+                if extension in [".html", ".xml", ".yml"]:
+                    files_to_upload.append(os.path.join(root, experiment_file))
+
+    # The archives are either built in the directory and uploaded like the other files,
+    # or built by each target while uploading them
+    zip_members = None
+    if args.zip == 'file':
+        files_to_upload.extend(create_zips(path, args.zip_level)[1:])
+    elif args.zip == 'stream':
+        yaml_in_zip, zip_members = get_zip_members(path)
+        zip_members = {archive: members for archive, members in zip_members.items()
+                       if len(members) > (1 if yaml_in_zip else 0)}
+
+    upload_queue = build_upload_queue(files_to_upload, args.upload_order, args.recent_hours, file_stats)
+
+    # Local checksums are computed once for all targets, --force uploads everything
+    local_hashes = None
+    if args.checksum and not args.force:
+        local_hashes = hash_local_files(files_to_upload)
+
+    return {
+        'path': path,
+        'yamlfile': yamlfile,
+        'yaml_timestamp': yaml_timestamp,
+        'experiment_name': experiment_name,
+        'epids': epids,
+        'ep_xml': ep_xml,
+        'indexfile': indexfile,
+        'upload_queue': upload_queue,
+        'local_hashes': local_hashes,
+        'resource_groups': resource_groups,
+        'force': args.force,
+        'zip_members': zip_members,
+        'zip_level': args.zip_level,
+    }
+
+
+def open_events(events_arg):
+    """Create the UploadEvents for the --events argument."""
+    # The progress display would garble JSON lines on standard output
+    if events_arg == '-':
+        return UploadEvents(sys.stdout, live=False)
+    elif events_arg:
+        return UploadEvents(open(events_arg, 'a', encoding='utf-8'))
+    return UploadEvents()
+
+
+def open_spool(db):
+    """
+    Open the spool database, creating its table if needed.
 
-            curl_send_file(indexfile, curl_target, action='PUT')
-        else:
-            curl_target = BASE_URL + "/id/eprint/" + str(epid) + "/contents"
-            logging.debug(f"Adding files to a new entry {epid}")
-            logging.debug(f"File tu upload: {indexfile}")
-            logging.debug(f"Target url: {curl_target}")
+    Every job is one experiment directory for one target. Its status is pending (waiting, possibly for a
+    retry at next_attempt), running, done or dead (failed SPOOL_MAX_ATTEMPTS times).
+    """
+    # Autocommit, the transactions that need it are started explicitly
+    conn = sqlite3.connect(db, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    # Readers (e.g. --spool-status) do not block the workers
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            target TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL,
+            enqueued REAL NOT NULL,
+            updated REAL NOT NULL,
+            worker TEXT,
+            last_error TEXT
+        )""")
+    # An experiment is pending at most once per target, a pending job uploads the newest files anyway
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS jobs_pending ON jobs (path, target) WHERE status = 'pending'")
+    return conn
+
+
+def spool_enqueue(db, paths, target_names):
+    """Add the experiment directories to the spool for every target, returns the number of new jobs."""
+    now = time.time()
+    added = 0
+    conn = open_spool(db)
+    try:
+        for path in paths:
+            for name in target_names:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO jobs (path, target, next_attempt, enqueued, updated) VALUES (?, ?, ?, ?, ?)",
+                    (os.path.abspath(path), name, now, now, now))
+                added += cursor.rowcount
+    finally:
+        conn.close()
+    return added
+
+
+def claim_spool_job(conn, worker):
+    """
+    Mark the next due job as running and return it, or None if no job is due.
 
-            curl_send_file(indexfile, curl_target, action='POST')
+    Jobs of an experiment that is being uploaded to any target wait, so no two processes
+    write the eprint id into the same YAML file.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Jobs of crashed workers run again, unless the experiment is pending again anyway
+        conn.execute("UPDATE OR IGNORE jobs SET status = 'pending', next_attempt = ?, updated = ? "
+                     "WHERE status = 'running' AND updated < ?", (now, now, now - SPOOL_STALE_SECONDS))
+        conn.execute("DELETE FROM jobs WHERE status = 'running' AND updated < ?", (now - SPOOL_STALE_SECONDS,))
+
+        job = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'pending' AND next_attempt <= ? "
+            "AND path NOT IN (SELECT path FROM jobs WHERE status = 'running') "
+            "ORDER BY next_attempt, id LIMIT 1", (now,)).fetchone()
+        if job is not None:
+            conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, updated = ? "
+                         "WHERE id = ?", (worker, now, job['id']))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return job
+
+
+def finish_spool_job(conn, job, error=None):
+    """Mark a claimed job as done, or schedule its retry with exponential backoff if error is set."""
+    now = time.time()
+    attempts = job['attempts'] + 1
+    if error is None:
+        conn.execute("UPDATE jobs SET status = 'done', updated = ?, last_error = NULL WHERE id = ?", (now, job['id']))
+    elif attempts >= SPOOL_MAX_ATTEMPTS:
+        logging.error(f"[{job['target']}] Giving up on {job['path']} after {attempts} attempts: {error}")
+        conn.execute("UPDATE jobs SET status = 'dead', updated = ?, last_error = ? WHERE id = ?",
+                     (now, error, job['id']))
+    else:
+        delay = min(SPOOL_RETRY_BASE * 2 ** (attempts - 1), SPOOL_RETRY_MAX)
+        logging.warning(f"[{job['target']}] Upload of {job['path']} failed ({error}), retrying in "
+                        f"{format_duration(delay)}")
+        # If the experiment was enqueued again meanwhile, that job covers the retry
+        cursor = conn.execute("UPDATE OR IGNORE jobs SET status = 'pending', next_attempt = ?, updated = ?, "
+                              "last_error = ? WHERE id = ?", (now + delay, now, error, job['id']))
+        if cursor.rowcount == 0:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job['id'],))
+
+
+def run_spool_job(job, target, args, events):
+    """Synchronize the experiment of a job with its target, returns None on success or the error."""
+    path = job['path']
+    if not os.path.isdir(path):
+        return f"No valid directory path {path}"
+
+    failed_before = events.failed_files
+    try:
+        experiment = prepare_experiment(path, args, [target])
+        if experiment is None:
+            # Finished experiments are not uploaded anymore
+            return None
+        sync_target(target, experiment, args.gzip_level if args.gzip else None, None, events)
+    except SystemExit as err:
+        # e.g. create_ep_xml_schema exits when the YAML lacks metadata, that must not end the worker
+        return "Exited, see the log" if err.code is None else f"Exited with {err.code}, see the log"
+    except Exception as err:
+        return f"{type(err).__name__}: {err}"
 
-        # Fetch the main document ID after the first upload
-        response = get_document_ids(epid, experiment_name, yaml_timestamp=None, type='document')
+    if events.failed_files > failed_before:
+        return f"{events.failed_files - failed_before} uploads failed"
+    return None
 
-        logging.debug("Response of first upload")
-        logging.debug(response)
 
-        docid = False
-        if response and len(response) > 0:
-            docid = response[0]
-            logging.debug(f"Docid {docid} was request")
-        else:
-            logging.debug("No docid could be requested")
+def spool_heartbeat(db, job_id, stop):
+    """Refresh the updated time of a running job until stop is set, so it is not taken for a crashed one."""
+    conn = open_spool(db)
+    try:
+        while not stop.wait(SPOOL_HEARTBEAT_SECONDS):
+            try:
+                conn.execute("UPDATE jobs SET updated = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+            except sqlite3.Error as err:
+                logging.debug(f"Heartbeat of job {job_id} failed: {err}")
+    finally:
+        conn.close()
 
-        if docid:
-            # Collect all files that need to process
-            files_to_upload = []
-            for root, dirs, files in os.walk(path):
-                for experiment_file in files:
-                    filename, extension = os.path.splitext(experiment_file)
-                    if extension in [".html", ".xml", ".yml"]:
-                        files_to_upload.append(os.path.join(root, experiment_file))
 
-            total_files = len(files_to_upload)
-            logging.info(f"Total files to upload: {total_files}")
+def spool_worker(db, targets, args):
+    """
+    Upload the due jobs of the spool one after another until none is left, in a process of its own.
 
-            bar_length = 40
+    targets maps the target names to their targets. Returns the number of failed jobs.
+    """
+    global verbose, home
+    # The globals set in __main__ do not exist in processes that are spawned instead of forked (Windows)
+    verbose = args.verbose
+    home = os.path.expanduser("~")
+    logging.basicConfig(
+        level=logging.DEBUG if verbose else logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
 
-            for i, experiment_file in enumerate(files_to_upload):
-                headers = {}
-                filename, extension = os.path.splitext(experiment_file)
+    worker = f"{os.uname().nodename if hasattr(os, 'uname') else ''}:{os.getpid()}"
+    events = open_events(args.events)
+    # Several processes share the terminal, so there is no progress bar
+    events.live = False
 
-                action = "POST"
+    failed = 0
+    conn = open_spool(db)
+    try:
+        while True:
+            job = claim_spool_job(conn, worker)
+            if job is None:
+                break
+
+            logging.info(f"[{job['target']}] Uploading {job['path']} (attempt {job['attempts'] + 1})")
+            target = targets.get(job['target'])
+            if target is None:
+                error = f"Unknown target {job['target']}"
+            else:
+                stop = threading.Event()
+                heartbeat = threading.Thread(target=spool_heartbeat, args=(db, job['id'], stop), daemon=True)
+                heartbeat.start()
+                try:
+                    error = run_spool_job(job, target, args, events)
+                finally:
+                    stop.set()
+                    heartbeat.join()
+            if error is not None:
+                failed += 1
+            finish_spool_job(conn, job, error)
+    finally:
+        conn.close()
+        events.close()
+        if events.stream not in (None, sys.stdout):
+            events.stream.close()
+
+    return failed
+
+
+def drain_spool(db, args, net, workers=SPOOL_WORKERS):
+    """
+    Upload all due jobs of the spool with a pool of worker processes, returns the number of failed jobs.
 
-                # Check if the file already exists on the server
-                existing_file_id = get_existing_file_id(epid, os.path.basename(experiment_file))
-                if existing_file_id:
-                    # action = "PUT"
-                    logging.debug(f"File with id {existing_file_id} already exists!")
-                    # If file exists, delete it first before re-uploading
-                    delete_existing_file(existing_file_id)
+    Jobs that are waiting for a retry later are left for the next run.
+    """
+    conn = open_spool(db)
+    try:
+        names = [row['target'] for row in conn.execute(
+            "SELECT DISTINCT target FROM jobs WHERE status IN ('pending', 'running')")]
+    finally:
+        conn.close()
+
+    # Credentials are read (or prompted for) once here, the workers cannot prompt
+    targets = {name: load_target(name, args.user, net) for name in names if name in SERVERS}
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(spool_worker, db, targets, args) for _ in range(workers)]
+        for future in futures:
+            try:
+                failed += future.result()
+            except Exception as err:
+                logging.error(f"Spool worker failed: {err}")
+                failed += 1
+
+    return failed
+
+
+def requeue_dead_jobs(db):
+    """Give the dead letters of the spool a new set of attempts, returns their number."""
+    now = time.time()
+    conn = open_spool(db)
+    try:
+        cursor = conn.execute("UPDATE OR IGNORE jobs SET status = 'pending', attempts = 0, next_attempt = ?, "
+                              "updated = ? WHERE status = 'dead'", (now, now))
+        # Dead letters of experiments that are pending again anyway
+        conn.execute("DELETE FROM jobs WHERE status = 'dead'")
+        return cursor.rowcount
+    finally:
+        conn.close()
+
+
+def print_spool_status(db):
+    """Print the number of jobs per status, the jobs waiting for a retry and the dead letters."""
+    now = time.time()
+    conn = open_spool(db)
+    try:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        print(f"Spool {db}")
+        for status in ['pending', 'running', 'done', 'dead']:
+            print(f"  {status:<8} {counts.get(status, 0)}")
+
+        retries = conn.execute("SELECT * FROM jobs WHERE status = 'pending' AND attempts > 0 "
+                               "ORDER BY next_attempt").fetchall()
+        if retries:
+            print("Waiting for a retry:")
+        for job in retries:
+            print(f"  #{job['id']} {job['path']} -> {job['target']}, attempt {job['attempts'] + 1} in "
+                  f"{format_duration(max(job['next_attempt'] - now, 0))}: {job['last_error']}")
+
+        dead = conn.execute("SELECT * FROM jobs WHERE status = 'dead' ORDER BY updated").fetchall()
+        if dead:
+            print("Dead letters (retry with --requeue-dead):")
+        for job in dead:
+            print(f"  #{job['id']} {job['path']} -> {job['target']}, {job['attempts']} attempts: {job['last_error']}")
+    finally:
+        conn.close()
 
-                # if experiment_file != indexfile:
-                if verbose:
-                    logging.debug(f"Attempt to upload {filename}.{extension}")
 
-                curl_target = BASE_URL + "/id/document/" + docid + "/contents"
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Eprits SWORD client')
+    parser.add_argument('--path', '-p', type=str, nargs='+',
+                        help='Directory for uploading, several experiment directories can be given')
+    parser.add_argument('--epid', '-i', type=int,
+                        help='Eprints Id to append or false to create new entry')
+    parser.add_argument('--user', '-u', type=str, help='Eprints username')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Show additional information')
+    parser.add_argument('--force', action='store_true', help='Force update')
+    parser.add_argument("--auto", action="store_true", help="Run without user interaction")
+    parser.add_argument('--gzip', action='store_true',
+                        help='Upload text files (' + ', '.join(COMPRESSIBLE_EXTENSIONS) + ') gzip compressed')
+    parser.add_argument('--gzip-level', type=int, default=DEFAULT_COMPRESS_LEVEL, choices=range(1, 10),
+                        metavar='[1-9]', help='Compression level for --gzip (default: %(default)s)')
+    parser.add_argument('--zip', nargs='?', const='file', choices=['file', 'stream'],
+                        help='Also upload xml.zip and pdf.zip of the experiment: built in the experiment directory, '
+                             'reusing the entries of unchanged files (file, default), or built while uploading '
+                             'without a file on disk (stream, curl still holds the whole archive in memory)')
+    parser.add_argument('--zip-level', type=int, default=DEFAULT_COMPRESS_LEVEL, choices=range(0, 10),
+                        metavar='[0-9]', help='Compression level of the --zip archives (default: %(default)s)')
+    parser.add_argument('--checksum', action='store_true',
+                        help='Only upload files whose MD5 hash or size differs from the file on the server')
+    parser.add_argument('--manifest', action='store_true',
+                        help='Upload the files listed under resources in the YAML and the HTML reports '
+                             'instead of searching the whole directory')
+    parser.add_argument('--shard-by-resource', action='store_true',
+                        help='Keep the data files of every resource group of the YAML in a document of their own')
+    parser.add_argument('--upload-order', type=str, default=UPLOAD_ORDER,
+                        help='Comma separated upload tiers in order of priority, out of: html, yml, recent, xml, '
+                             'other (default: %(default)s)')
+    parser.add_argument('--recent-hours', type=float, default=RECENT_HOURS,
+                        help='Recordings changed within this many hours are uploaded in the "recent" tier '
+                             '(default: %(default)s)')
+    parser.add_argument('--events', type=str,
+                        help='Write a JSON line for every queued, started, finished and failed upload to this file '
+                             '("-" for standard output)')
+    parser.add_argument('--profile', type=str, metavar='DIRECTORY',
+                        help='Profile CPU time (cProfile) and allocations (tracemalloc) of the run and write '
+                             'sorted reports to this directory')
+    parser.add_argument('--spool', action='store_true',
+                        help='Add the experiments to the spool of --drain instead of uploading them')
+    parser.add_argument('--drain', action='store_true',
+                        help='Upload the due experiments of the spool with --workers processes, '
+                             'failed uploads are retried later with increasing delays')
+    parser.add_argument('--workers', type=int, default=SPOOL_WORKERS,
+                        help='Number of upload processes for --drain (default: %(default)s)')
+    parser.add_argument('--spool-status', action='store_true',
+                        help='Show the jobs of the spool, their retries and the dead letters')
+    parser.add_argument('--requeue-dead', action='store_true',
+                        help='Retry the jobs of the spool that failed too often')
+    parser.add_argument('--spool-db', type=str, default=SPOOL_DB,
+                        help='SQLite database of the spool (default: %(default)s)')
+    parser.add_argument('--targets', type=str, default=SYNC_TARGETS or DEFAULT_SERVER,
+                        help='Comma separated servers to sync to concurrently, out of: ' + ', '.join(SERVERS) +
+                             ' (default: %(default)s)')
 
-                logging.debug(f"Send to {curl_target} via {action}")
+    args = parser.parse_args()
 
-                curl_send_file(experiment_file, url=curl_target, action=action)
+    paths = args.path
+    user = args.user
+    verbose = args.verbose
+    force = args.force
+    compress_level = args.gzip_level if args.gzip else None
+
+    target_names = [name.strip() for name in args.targets.split(',') if name.strip()]
+    for name in target_names:
+        if name not in SERVERS:
+            parser.error(f"Unknown target {name}, choose from: {', '.join(SERVERS)}")
+    for tier in args.upload_order.split(','):
+        if tier.strip() and tier.strip() not in UPLOAD_TIERS:
+            parser.error(f"Unknown upload tier {tier.strip()}, choose from: {', '.join(UPLOAD_TIERS)}")
+    if args.epid and len(target_names) > 1:
+        parser.error("--epid can only be used with a single target")
+    if args.epid and args.path and len(args.path) > 1:
+        parser.error("--epid can only be used with a single path")
 
-                # Update the progress bar
-                progress = (i + 1) / total_files
-                block = int(round(bar_length * progress))
-                text = f"\rUploading: [{'#' * block + '-' * (bar_length - block)}] {progress * 100:.1f}% ({i + 1}/{total_files})"
-                sys.stdout.write(text)
-                sys.stdout.flush()
-            print()
-            logging.info("Upload finished")
+    logging.basicConfig(
+        level=logging.DEBUG if verbose else logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
 
+    if verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
     else:
-        logging.info("HTML file doesn't exist")
+        logging.getLogger().setLevel(logging.INFO)
+
+    if args.profile:
+        profiling = True
+        tracemalloc.start()
+        main_profiler = cProfile.Profile()
+        profilers.append(main_profiler)
+        main_profiler.enable()
+        # Also written when the run ends early with exit()
+        atexit.register(write_profile_reports, args.profile)
+
+    if args.spool_status:
+        print_spool_status(args.spool_db)
+        sys.exit(0)
+
+    if args.requeue_dead:
+        logging.info(f"{requeue_dead_jobs(args.spool_db)} dead jobs were queued again")
+        sys.exit(0)
+
+    if args.drain:
+        from os.path import expanduser
+        home = expanduser("~")
+        # The workers cannot be asked whether the eprint ids are right
+        args.auto = True
+        args.epid = None
+        failed_jobs = drain_spool(args.spool_db, args, load_netrc(), args.workers)
+        if failed_jobs:
+            logging.warning(f"{failed_jobs} jobs failed, see --spool-status")
+            sys.exit(1)
+        sys.exit(0)
+
+    # If no path set, read from cmd
+    if paths is None:
+        paths = [input("File/Directory: ")]
+
+    for path in paths:
+        # File or folder exist?
+        assert os.path.exists(path), "Path not found: " + str(path)
+        assert os.path.isdir(path), "No valid directory path " + str(path)
+
+    if args.spool:
+        added = spool_enqueue(args.spool_db, paths, target_names)
+        logging.info(f"{added} jobs added to the spool {args.spool_db}")
+        sys.exit(0)
+
+    from os.path import expanduser
+
+    # Get the user's home directory
+    home = expanduser("~")
+
+    # Load netrc for authentication
+    net = load_netrc()
+
+    # Every target keeps its own credentials
+    targets = [load_target(name, user, net) for name in target_names]
+
+    experiments = []
+    for path in paths:
+        experiment = prepare_experiment(path, args, targets)
+        if experiment is not None:
+            experiments.append(experiment)
+
+    if not experiments:
+        exit()
 
-    # Delete the ep_xml file
-    cleanup()
+    events = open_events(args.events)
+
+    failed = False
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = {}
+        for target in targets:
+            futures[target['name']] = executor.submit(run_profiled, sync_experiments, target, experiments,
+                                                      compress_level, events)
+
+        for name, future in futures.items():
+            try:
+                if not future.result():
+                    failed = True
+            except Exception as err:
+                logging.error(f"[{name}] Synchronization failed: {err}")
+                failed = True
+
+    events.close()
+    if events.stream not in (None, sys.stdout):
+        events.stream.close()
+
+    if failed:
+        sys.exit(1)